@@ -55,11 +55,17 @@ def load_results(dirname, result_df=None, columns=None):
     print("Will load", len(peptides), "peptides and", len(manifest_df), "cols")
 
     for _, row in tqdm.tqdm(manifest_df.iterrows(), total=len(manifest_df)):
-        with open(os.path.join(dirname, row.path), "rb") as fd:
-            value = numpy.load(fd)['arr_0'].astype(numpy.float32)
-            if mask is not None:
-                value = value[mask]
-            result_df.loc[peptides_to_assign, row.col] = value
+        path = os.path.join(dirname, row.path)
+        if path.endswith(".npz"):
+            # Older predictions were written as npz archives.
+            with open(path, "rb") as fd:
+                value = numpy.load(fd)['arr_0']
+        else:
+            value = numpy.load(path, mmap_mode="r")
+        if mask is not None:
+            value = value[mask]
+        result_df.loc[peptides_to_assign, row.col] = value.astype(
+            numpy.float32)
 
     return result_df
 
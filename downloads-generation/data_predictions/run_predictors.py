@@ -5,9 +5,9 @@ import os
 import signal
 import sys
 import time
+import threading
 import traceback
 import math
-import collections
 from functools import partial
 
 import numpy
@@ -17,6 +17,7 @@ from mhcflurry.common import normalize_allele_name
 import tqdm  # progress bar
 tqdm.monitor_interval = 0  # see https://github.com/tqdm/tqdm/issues/481
 
+from mhcflurry import Class1AffinityPredictor
 from mhcflurry.common import configure_logging
 from mhcflurry.local_parallelism import (
     add_local_parallelism_args,
@@ -93,15 +94,148 @@ PREDICTOR_TO_COLS = {
     "mixmhcpred": ["score"],
 }
 
+# While running, all predictions are kept in a memory-mapped peptides x columns
+# matrix in the output directory, which is removed once the per-column files
+# are written at the end. If a run is interrupted, load_results reads this
+# matrix so the run can be resumed with --reuse-predictions.
+IN_PROGRESS_FILENAME = "predictions.in_progress.npy"
 
-def load_results(dirname, result_df=None, dtype="float32"):
-    peptides = pandas.read_csv(
-        os.path.join(dirname, "peptides.csv")).peptide
+# Lookup table indexed by character code giving whether the character may
+# appear in a peptide. Code 0 is allowed since numpy pads fixed-width strings
+# with it; code 255 stands in for all codes above 255 and is never allowed.
+VALID_PEPTIDE_CHARACTER_CODES = numpy.zeros(256, dtype=bool)
+VALID_PEPTIDE_CHARACTER_CODES[[ord(c) for c in "ACDEFGHIKLMNPQRSTVWY"]] = True
+VALID_PEPTIDE_CHARACTER_CODES[0] = True
+
+
+def valid_peptides_mask(peptides, chunk_size=1000000):
+    """
+    Find the peptides consisting only of the 20 standard amino acids.
+
+    Rather than matching a regular expression against each peptide, the
+    peptides are converted to a fixed-width string array and its character
+    codes are checked with a lookup table in bulk.
+
+    Parameters
+    ----------
+    peptides : list or numpy.ndarray of string
+    chunk_size : int
+        Number of peptides to check at once. Bounds the memory used.
+
+    Returns
+    -------
+    numpy.ndarray of bool
+    """
+    result = numpy.zeros(len(peptides), dtype=bool)
+    for start in range(0, len(peptides), chunk_size):
+        chunk = numpy.asarray(peptides[start : start + chunk_size], dtype="U")
+        codes = numpy.minimum(
+            chunk.view(numpy.uint32).reshape(
+                len(chunk), chunk.itemsize // 4),
+            255)
+        result[start : start + len(chunk)] = (
+            VALID_PEPTIDE_CHARACTER_CODES[codes].all(axis=1) &
+            (codes[:, 0] != 0))
+    return result
+
+
+def group_rows_by_nonzero_columns(arr):
+    """
+    Group the rows of a binary matrix by their pattern of nonzero columns.
+
+    Rows are compared by packing each into bits and sorting the packed rows
+    with numpy. The column indices for each group are decoded in bulk from the
+    unique packed rows, so the only python-level work is building the result
+    dict.
+
+    Parameters
+    ----------
+    arr : numpy.ndarray of shape (num rows, num cols)
+
+    Returns
+    -------
+    dict of tuple of int -> numpy.ndarray of int
+
+    Maps column indices to the indices of the rows that are nonzero at
+    exactly those columns. Rows that are entirely zero are omitted.
+    """
+    arr = numpy.asarray(arr, dtype=bool)
+    (nonzero_rows,) = numpy.nonzero(arr.any(axis=1))
+    if len(nonzero_rows) == 0:
+        return {}
+
+    packed = numpy.packbits(arr[nonzero_rows], axis=1)
+    keys = packed.view(numpy.dtype((numpy.void, packed.shape[1]))).ravel()
+    (unique_keys, inverse) = numpy.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    rows_by_group = numpy.split(
+        nonzero_rows[numpy.argsort(inverse, kind="stable")],
+        numpy.cumsum(numpy.bincount(inverse))[:-1])
+
+    (group_nums, cols) = numpy.nonzero(
+        numpy.unpackbits(
+            unique_keys.view(numpy.uint8).reshape(len(unique_keys), -1),
+            axis=1,
+            count=arr.shape[1]))
+    cols_by_group = numpy.split(
+        cols, numpy.cumsum(numpy.bincount(group_nums))[:-1])
+
+    return dict(
+        (tuple(group_cols), rows)
+        for (group_cols, rows) in zip(cols_by_group, rows_by_group))
+
+
+def chunk_ranges(num_items, chunk_size):
+    """
+    Split a range of items into contiguous chunks of nearly equal size.
+
+    Like numpy.array_split, but gives (start, stop) offsets instead of
+    materializing the chunks.
+
+    Parameters
+    ----------
+    num_items : int
+    chunk_size : int
+        Maximum number of items per chunk
+
+    Returns
+    -------
+    generator of (int, int)
+    """
+    num_chunks = int(math.ceil(num_items / chunk_size))
+    for i in range(num_chunks):
+        yield (
+            i * num_items // num_chunks,
+            (i + 1) * num_items // num_chunks)
+
+
+def load_results(dirname, peptides=None, col_to_values=None, dtype="float32"):
+    """
+    Load predictions written by run().
+
+    Parameters
+    ----------
+    dirname : string
+        Output directory of a previous run
+    peptides : numpy.ndarray of string
+        Peptides that the arrays in col_to_values are aligned with
+    col_to_values : dict of string -> numpy.ndarray
+        Arrays to update in place. If not specified, all predictions in
+        dirname are loaded and returned as a DataFrame.
+    dtype : string
+
+    Returns
+    -------
+    pandas.DataFrame if col_to_values is not specified, otherwise
+    col_to_values
+    """
+    existing_peptides = pandas.read_csv(
+        os.path.join(dirname, "peptides.csv")).peptide.values
     manifest_df = pandas.read_csv(os.path.join(dirname, "alleles.csv"))
 
     print(
         "Loading results. Existing data has",
-        len(peptides),
+        len(existing_peptides),
         "peptides and",
         len(manifest_df),
         "columns")
@@ -111,30 +245,68 @@ def load_results(dirname, result_df=None, dtype="float32"):
         manifest_df["kind"] = "affinity"
     if "col" not in manifest_df.columns:
         manifest_df["col"] = manifest_df.allele + " " + manifest_df.kind
-
-    if result_df is None:
-        result_df = pandas.DataFrame(
-            index=peptides,
-            columns=manifest_df.col.values,
-            dtype=dtype)
-        result_df[:] = numpy.nan
-        peptides_to_assign = peptides
-        mask = None
+    manifest_df["column_index"] = numpy.arange(len(manifest_df))
+
+    in_progress_values = None
+    in_progress_path = os.path.join(dirname, IN_PROGRESS_FILENAME)
+    if os.path.exists(in_progress_path):
+        print("Using predictions from interrupted run", in_progress_path)
+        in_progress_values = numpy.load(in_progress_path, mmap_mode="r")
+        assert in_progress_values.shape == (
+            len(existing_peptides), len(manifest_df)), (
+            in_progress_values.shape)
+
+    return_df = col_to_values is None
+    if return_df:
+        # Allocate all columns as one column-major buffer that the returned
+        # DataFrame wraps without copying.
+        peptides = existing_peptides
+        result_values = numpy.full(
+            (len(peptides), len(manifest_df)),
+            numpy.nan,
+            dtype=dtype,
+            order="F")
+        col_to_values = dict(
+            (col, result_values[:, i])
+            for (i, col) in enumerate(manifest_df.col.values))
     else:
-        manifest_df = manifest_df.loc[manifest_df.col.isin(result_df.columns)]
-        mask = (peptides.isin(result_df.index)).values
-        peptides_to_assign = peptides[mask]
+        manifest_df = manifest_df.loc[manifest_df.col.isin(list(col_to_values))]
 
-    print("Will load", len(peptides), "peptides and", len(manifest_df), "cols")
+    # Positions of the existing peptides in the peptides array (-1 if absent),
+    # so values can be assigned with numpy indexing instead of pandas label
+    # lookups.
+    positions = pandas.Index(peptides).get_indexer(existing_peptides)
+    (existing_indices,) = numpy.nonzero(positions >= 0)
+    positions = positions[existing_indices]
 
-    for _, row in tqdm.tqdm(manifest_df.iterrows(), total=len(manifest_df)):
-        with open(os.path.join(dirname, row.path), "rb") as fd:
-            value = numpy.load(fd)['arr_0']
-            if mask is not None:
-                value = value[mask]
-            result_df.loc[peptides_to_assign, row.col] = value
+    print(
+        "Will load",
+        len(existing_indices),
+        "peptides and",
+        len(manifest_df),
+        "cols")
 
-    return result_df
+    for _, row in tqdm.tqdm(manifest_df.iterrows(), total=len(manifest_df)):
+        path = os.path.join(dirname, row.path)
+        if in_progress_values is not None:
+            value = in_progress_values[:, row.column_index]
+        elif path.endswith(".npz"):
+            # Older runs wrote each column as an npz archive.
+            with open(path, "rb") as fd:
+                value = numpy.load(fd)['arr_0']
+        else:
+            # Memory map the column so only the pages holding the needed
+            # peptides are read.
+            value = numpy.load(path, mmap_mode="r")
+        col_to_values[row.col][positions] = value[existing_indices]
+
+    if return_df:
+        return pandas.DataFrame(
+            result_values,
+            index=peptides,
+            columns=manifest_df.col.values,
+            copy=False)
+    return col_to_values
 
 
 def run(argv=sys.argv[1:]):
@@ -159,12 +331,19 @@ def run(argv=sys.argv[1:]):
 
     alleles = numpy.array(sorted({a for a in alleles if a}))
 
-    peptides = pandas.read_csv(
-        args.input_peptides, nrows=args.max_peptides).peptide.drop_duplicates()
+    # Only the peptide column is parsed. From here on peptides are kept in a
+    # fixed-width string array. Duplicates are dropped once, after filtering,
+    # by numpy.unique, which also sorts the peptides.
+    peptides = numpy.asarray(
+        pandas.read_csv(
+            args.input_peptides,
+            usecols=["peptide"],
+            nrows=args.max_peptides).peptide.values,
+        dtype="U")
     print("Filtering to valid peptides. Starting at: ", len(peptides))
-    peptides = peptides[peptides.str.match("^[ACDEFGHIKLMNPQRSTVWY]+$")]
+    peptides = peptides[valid_peptides_mask(peptides)]
     print("Filtered to: ", len(peptides))
-    peptides = peptides.unique()
+    peptides = numpy.unique(peptides)
     num_peptides = len(peptides)
 
     print("Predictions for %d alleles x %d peptides." % (
@@ -178,6 +357,26 @@ def run(argv=sys.argv[1:]):
     GLOBAL_DATA["args"] = args
     GLOBAL_DATA["cols"] = PREDICTOR_TO_COLS[args.predictor]
 
+    # Work items give the positions of their peptides in this array instead of
+    # the peptides themselves, so peptides are not serialized for each task.
+    # A fixed-width string array has no per-element python objects, so forked
+    # workers share its pages without copying them (reference count updates
+    # would otherwise touch every page), and on a cluster it is serialized once
+    # as a single buffer along with the rest of GLOBAL_DATA.
+    GLOBAL_DATA["peptides"] = peptides
+
+    if args.predictor == "mhcflurry" and not args.cluster_parallelism:
+        # Load the predictor once here so forked workers inherit it instead of
+        # each reloading it. The weights are read now so they are shared too.
+        # Optimization is left to the workers since it builds tensorflow
+        # models, which must not happen before forking.
+        predictor = Class1AffinityPredictor.load(
+            args.mhcflurry_models_dir, optimization_level=0)
+        for network in predictor.neural_networks:
+            network.load_weights()
+        GLOBAL_DATA["mhcflurry_predictor"] = predictor
+        print("Loaded predictor", predictor)
+
     # Write peptide and allele lists to out dir.
     out_peptides = os.path.abspath(os.path.join(args.out, "peptides.csv"))
     pandas.DataFrame({"peptide": peptides}).to_csv(out_peptides, index=False)
@@ -192,92 +391,131 @@ def run(argv=sys.argv[1:]):
     manifest_df["col"] = (
             manifest_df.allele + " " + manifest_df.kind)
     manifest_df["path"] = manifest_df.col.map(
-        lambda s: s.replace("*", "").replace(" ", ".")) + ".npz"
+        lambda s: s.replace("*", "").replace(" ", ".")) + ".npy"
     out_manifest = os.path.abspath(os.path.join(args.out, "alleles.csv"))
     manifest_df.to_csv(out_manifest, index=False)
     col_to_filename = manifest_df.set_index("col").path.map(
         lambda s: os.path.abspath(os.path.join(args.out, s)))
     print("Wrote: ", out_manifest)
 
-    result_df = pandas.DataFrame(
-        index=peptides, columns=manifest_df.col.values, dtype=args.result_dtype)
-    result_df[:] = numpy.nan
+    # Predictions are stored in a single peptides x columns matrix, memory
+    # mapped to a file in the output directory. We use column-major (Fortran)
+    # order so that each column is contiguous, since results are written and
+    # scanned one column at a time. The file is created under a temporary name
+    # and renamed after any existing predictions are loaded, since one of the
+    # --reuse-predictions directories may be an interrupted run in args.out.
+    in_progress_path = os.path.join(args.out, IN_PROGRESS_FILENAME)
+    result_values = numpy.lib.format.open_memmap(
+        in_progress_path + ".tmp",
+        mode="w+",
+        dtype=args.result_dtype,
+        shape=(num_peptides, len(manifest_df)),
+        fortran_order=True)
+    result_values[:] = numpy.nan
+    col_to_values = dict(
+        (col, result_values[:, i])
+        for (i, col) in enumerate(manifest_df.col.values))
 
     if args.reuse_predictions:
         # Allocating this here to hit any memory errors as early as possible.
         is_null_matrix = numpy.ones(
-            shape=(result_df.shape[0], len(alleles)), dtype="int8")
+            shape=(num_peptides, len(alleles)), dtype=bool)
 
         for dirname in args.reuse_predictions:
             if not dirname:
                 continue  # ignore empty strings
             if os.path.exists(dirname):
                 print("Loading predictions", dirname)
-                result_df = load_results(
-                    dirname, result_df, dtype=args.result_dtype)
+                load_results(
+                    dirname,
+                    peptides=peptides,
+                    col_to_values=col_to_values,
+                    dtype=args.result_dtype)
             else:
                 print("WARNING: skipping because does not exist", dirname)
 
         # We rerun any alleles that have nulls for any kind of values
-        # (e.g. affinity, percentile rank, elution score).
-        for (i, allele) in enumerate(alleles):
-            sub_df = manifest_df.loc[manifest_df.allele == allele]
-            is_null_matrix[:, i] = result_df[sub_df.col.values].isnull().any(1)
-        print("Fraction null", is_null_matrix.mean())
+        # (e.g. affinity, percentile rank, elution score). The manifest lists
+        # the columns for each allele contiguously and sorted by allele, so
+        # each allele's columns can be reduced together in one numpy call.
+        allele_col_starts = numpy.searchsorted(
+            manifest_df.allele.values, alleles)
+        numpy.logical_or.reduceat(
+            numpy.isnan(result_values),
+            allele_col_starts,
+            axis=1,
+            out=is_null_matrix)
+        print(
+            "Fraction null",
+            numpy.count_nonzero(is_null_matrix) / is_null_matrix.size)
 
         print("Grouping peptides by alleles")
-        allele_indices_to_peptides = collections.defaultdict(list)
-        for (i, peptide) in tqdm.tqdm(enumerate(peptides), total=len(peptides)):
-            (allele_indices,) = numpy.where(is_null_matrix[i])
-            if len(allele_indices) > 0:
-                allele_indices_to_peptides[tuple(allele_indices)].append(peptide)
+        start = time.time()
+        allele_indices_to_peptide_indices = group_rows_by_nonzero_columns(
+            is_null_matrix)
+        print("Found %d groups in %0.2f sec." % (
+            len(allele_indices_to_peptide_indices), time.time() - start))
 
         del is_null_matrix
 
         work_items = []
         print("Assigning peptides to work items.")
-        for (indices, block_peptides) in allele_indices_to_peptides.items():
-            num_chunks = int(math.ceil(len(block_peptides) / args.chunk_size))
-            peptide_chunks = numpy.array_split(peptides, num_chunks)
-            for chunk_peptides in peptide_chunks:
+        for (indices, peptide_indices) in (
+                allele_indices_to_peptide_indices.items()):
+            for (chunk_start, chunk_stop) in chunk_ranges(
+                    len(peptide_indices), args.chunk_size):
                 work_items.append({
                     'alleles': alleles[list(indices)],
-                    'peptides': chunk_peptides,
+                    'peptide_positions': peptide_indices[
+                        chunk_start : chunk_stop
+                    ],
+                    'num_peptides': chunk_stop - chunk_start,
                 })
     else:
-        # Same number of chunks for all alleles
-        num_chunks = int(math.ceil(len(peptides) / args.chunk_size))
-        print("Splitting peptides into %d chunks" % num_chunks)
-        peptide_chunks = numpy.array_split(peptides, num_chunks)
-
+        # Same number of chunks for all alleles. Each chunk is a contiguous
+        # range of peptides, so work items give it as a slice.
         work_items = []
-        for (_, chunk_peptides) in enumerate(peptide_chunks):
+        for (chunk_start, chunk_stop) in chunk_ranges(
+                num_peptides, args.chunk_size):
             work_item = {
                 'alleles': alleles,
-                'peptides': chunk_peptides,
+                'peptide_positions': slice(chunk_start, chunk_stop),
+                'num_peptides': chunk_stop - chunk_start,
             }
             work_items.append(work_item)
+        print("Split peptides into %d chunks" % len(work_items))
     print("Work items: ", len(work_items))
 
+    result_values.flush()
+    os.replace(in_progress_path + ".tmp", in_progress_path)
+    print("Wrote: ", in_progress_path)
+
     for (i, work_item) in enumerate(work_items):
         work_item["work_item_num"] = i
 
-    # Combine work items to form tasks.
-    tasks = []
-    peptides_in_last_task = None
-    # We sort work_items to put small items first so they get combined.
-    for work_item in sorted(work_items, key=lambda d: len(d['peptides'])):
-        if peptides_in_last_task is not None and (
-                len(work_item['peptides']) +
-                peptides_in_last_task < args.chunk_size):
-
-            # Add to last task.
-            tasks[-1]['work_item_dicts'].append(work_item)
-            peptides_in_last_task += len(work_item['peptides'])
-        else:
-            # New task
-            tasks.append({'work_item_dicts': [work_item]})
-            peptides_in_last_task = len(work_item['peptides'])
+    if args.cluster_parallelism:
+        # Each task is submitted as a separate cluster job, so we combine
+        # small work items to form tasks. We sort work_items to put small items
+        # first so they get combined, and start a new task whenever the running
+        # total of peptides reaches the next multiple of the chunk size. A task
+        # therefore has fewer than 2 * chunk_size peptides.
+        sizes = numpy.array(
+            [d['num_peptides'] for d in work_items], dtype=int)
+        order = numpy.argsort(sizes, kind="stable")
+        task_nums = (
+            numpy.cumsum(sizes[order]) - sizes[order]) // args.chunk_size
+        tasks = [
+            {'work_item_dicts': [work_items[i] for i in task_work_item_nums]}
+            for task_work_item_nums in numpy.split(
+                order, numpy.nonzero(numpy.diff(task_nums))[0] + 1)
+            if len(task_work_item_nums) > 0
+        ]
+    else:
+        # Locally, each work item is its own task. Workers pull the next task
+        # from the pool's queue as soon as they finish one (chunksize=1
+        # below), so a slow work item holds up only the worker running it
+        # rather than a whole batch of work items combined with it.
+        tasks = [{'work_item_dicts': [work_item]} for work_item in work_items]
 
     print("Collected %d work items into %d tasks" % (
         len(work_items), len(tasks)))
@@ -321,33 +559,57 @@ def run(argv=sys.argv[1:]):
     def write_col(col):
         out_path = os.path.join(
             args.out, col_to_filename[col])
-        numpy.savez(out_path, result_df[col].values)
+        values = col_to_values[col]
+        numpy.save(out_path, values)
         print(
             "Wrote [%f%% null]:" % (
-                result_df[col].isnull().mean() * 100.0),
+                numpy.isnan(values).mean() * 100.0),
             out_path)
 
-    print("Writing all columns.")
-    last_write_time_per_column = {}
-    for col in result_df.columns:
-        write_col(col)
-        last_write_time_per_column[col] = time.time()
-    print("Done writing all columns. Reading results.")
-
-    for worker_results in tqdm.tqdm(results, total=len(work_items)):
+    # Columns updated since the last checkpoint. A background thread flushes
+    # the results matrix to disk every few minutes if any are set, so the
+    # loop below does not have to check the time for each result.
+    dirty_cols = numpy.zeros(len(manifest_df), dtype=bool)
+    dirty_cols_lock = threading.Lock()
+    done_reading_results = threading.Event()
+
+    def checkpoint_periodically(interval=180):
+        while not done_reading_results.wait(interval):
+            with dirty_cols_lock:
+                num_dirty_cols = dirty_cols.sum()
+                dirty_cols[:] = False
+            if num_dirty_cols > 0:
+                result_values.flush()
+                print(
+                    "Checkpointed %d updated columns:" % num_dirty_cols,
+                    in_progress_path)
+
+    checkpoint_thread = threading.Thread(
+        target=checkpoint_periodically, daemon=True)
+    checkpoint_thread.start()
+
+    print("Reading results.")
+    cols_index = pandas.Index(manifest_df.col.values)
+    for worker_results in tqdm.tqdm(results, total=len(tasks)):
         for (work_item_num, col_to_predictions) in worker_results:
-            for (col, predictions) in col_to_predictions.items():
-                result_df.loc[
-                    work_items[work_item_num]['peptides'],
-                    col
-                ] = predictions
-                if time.time() - last_write_time_per_column[col] > 180:
-                    write_col(col)
-                    last_write_time_per_column[col] = time.time()
+            positions = work_items[work_item_num]['peptide_positions']
+            col_indices = cols_index.get_indexer(list(col_to_predictions))
+            assert (col_indices >= 0).all(), list(col_to_predictions)
+            for (col_index, predictions) in zip(
+                    col_indices, col_to_predictions.values()):
+                result_values[positions, col_index] = predictions
+            with dirty_cols_lock:
+                dirty_cols[col_indices] = True
+
+    done_reading_results.set()
+    checkpoint_thread.join()
 
     print("Done processing. Final write for each column.")
-    for col in result_df.columns:
+    result_values.flush()
+    for col in manifest_df.col.values:
         write_col(col)
+    os.remove(in_progress_path)
+    print("Removed: ", in_progress_path)
 
     if worker_pool:
         worker_pool.close()
@@ -360,9 +622,9 @@ def run(argv=sys.argv[1:]):
 
 def do_predictions_mhctools(work_item_dicts, constant_data=None):
     """
-    Each tuple of work items consists of:
-
-    (work_item_num, peptides, alleles)
+    Each dict of work items should have keys: work_item_num,
+    peptide_positions (slice or array of indices into the peptides array),
+    alleles
 
     """
 
@@ -383,7 +645,7 @@ def do_predictions_mhctools(work_item_dicts, constant_data=None):
     results = []
     for (i, d) in enumerate(work_item_dicts):
         work_item_num = d['work_item_num']
-        peptides = d['peptides']
+        peptides = constant_data['peptides'][d['peptide_positions']].tolist()
         alleles = d['alleles']
 
         print("Processing work item", i + 1, "of", len(work_item_dicts))
@@ -433,25 +695,33 @@ def do_predictions_mhctools(work_item_dicts, constant_data=None):
         print("Predicted for %d peptides x %d alleles in %0.2f sec." % (
             len(peptides), len(alleles), (time.time() - start)))
 
-        for (allele, sub_df) in df.groupby("allele"):
-            for col in cols:
-                result["%s %s" % (allele, col)] = (
-                    sub_df[col].values.astype(
-                        constant_data['args'].result_dtype))
+        # Pivot to one row per peptide, in the order of the peptides list, and
+        # cast to the result dtype in a single pass. The result arrays are
+        # (contiguous) columns of this one buffer.
+        wide_df = df.pivot(
+            index="peptide", columns="allele", values=cols).reindex(peptides)
+        values = numpy.asfortranarray(
+            wide_df.values, dtype=constant_data['args'].result_dtype)
+        for (j, (col, allele)) in enumerate(wide_df.columns):
+            result["%s %s" % (allele, col)] = values[:, j]
     return results
 
 
 def do_predictions_mhcflurry(work_item_dicts, constant_data=None):
     """
-    Each dict of work items should have keys: work_item_num, peptides, alleles
+    Each dict of work items should have keys: work_item_num,
+    peptide_positions (slice or array of indices into the peptides array),
+    alleles
 
     """
 
     # This may run on the cluster in a way that misses all top level imports,
     # so we have to re-import everything here.
     import time
+    import numpy
     from mhcflurry.encodable_sequences import EncodableSequences
     from mhcflurry import Class1AffinityPredictor
+    from mhcflurry.class1_affinity_predictor import OPTIMIZATION_LEVEL
 
     if constant_data is None:
         constant_data = GLOBAL_DATA
@@ -461,30 +731,48 @@ def do_predictions_mhcflurry(work_item_dicts, constant_data=None):
     assert args.predictor == "mhcflurry"
     assert constant_data['cols'] == ["affinity"]
 
-    predictor = Class1AffinityPredictor.load(args.mhcflurry_models_dir)
+    predictor = constant_data.get('mhcflurry_predictor')
+    if predictor is None:
+        predictor = Class1AffinityPredictor.load(args.mhcflurry_models_dir)
+    elif OPTIMIZATION_LEVEL >= 1:
+        # The shared predictor was loaded unoptimized. This is a no-op if this
+        # worker has already optimized it for a previous task.
+        predictor.optimize()
 
     results = []
     for (i, d) in enumerate(work_item_dicts):
         work_item_num = d['work_item_num']
-        peptides = d['peptides']
+        peptides = constant_data['peptides'][d['peptide_positions']]
         alleles = d['alleles']
 
         print("Processing work item", i + 1, "of", len(work_item_dicts))
         result = {}
         results.append((work_item_num, result))
         start = time.time()
+
+        # The peptides are encoded on the first prediction and the encoding is
+        # cached on this object, so it is reused for all alleles. We predict
+        # one allele at a time rather than passing an alleles array since the
+        # latter would require encoding each peptide once per allele.
         peptides = EncodableSequences.create(peptides)
-        for (i, allele) in enumerate(alleles):
+
+        # Predictions for all alleles are cast as they are stored into a single
+        # buffer, and the result arrays are (contiguous) columns of it.
+        predictions = numpy.empty(
+            (len(peptides), len(alleles)),
+            dtype=args.result_dtype,
+            order="F")
+        for (j, allele) in enumerate(alleles):
             print("Processing allele %d / %d: %0.2f sec elapsed" % (
-                i + 1, len(alleles), time.time() - start))
-            for col in ["affinity"]:
-                result["%s %s" % (allele, col)] = predictor.predict(
-                    peptides=peptides,
-                    allele=allele,
-                    throw=False,
-                    model_kwargs={
-                        'batch_size': args.mhcflurry_batch_size,
-                    }).astype(constant_data['args'].result_dtype)
+                j + 1, len(alleles), time.time() - start))
+            predictions[:, j] = predictor.predict(
+                peptides=peptides,
+                allele=allele,
+                throw=False,
+                model_kwargs={
+                    'batch_size': args.mhcflurry_batch_size,
+                })
+            result["%s affinity" % allele] = predictions[:, j]
         print("Done predicting in", time.time() - start, "sec")
     return results
 